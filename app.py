@@ -1,11 +1,35 @@
+import hashlib
 import json
-import re
+import time
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
 from typing import Any
+from urllib.parse import urlparse
 
 import requests
 import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 DEFAULT_TIMEOUT_S = 45
+RESPONSE_CACHE_TTL_S = 3600
+RESPONSE_CACHE_MAX_ENTRIES = 256
+SUMMARY_TRIGGER_CHARS = 4000
+SUMMARY_KEEP_MESSAGES = 6
+CANDIDATE_RESPONSES = 4
+# Strict json_schema output is only accepted by gpt-4o-mini, gpt-4o-2024-08-06 and newer model families.
+STRUCTURED_OUTPUT_MODELS = ("gpt-4o", "gpt-4.1", "gpt-5", "o1", "o3", "o4")
+UNSTRUCTURED_OUTPUT_MODELS = ("gpt-4o-2024-05-13", "o1-mini", "o1-preview")
+RECENT_MESSAGES = 2
+ROLE_LABELS = {"assistant": "Assistant", "user": "You"}
+ASSISTANT_MESSAGE_KEY = '"assistant_message"'
+JSON_DECODER = json.JSONDecoder()
 
 st.set_page_config(page_title="Skrepa Chat", page_icon="💬")
 
@@ -48,22 +72,113 @@ Rules:
 - Do not repeat the user's latest message at the start of assistant_message.
 """.strip()
 
+FORM_FIELD_SCHEMA = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": [
+        "key",
+        "label",
+        "type",
+        "required",
+        "help",
+        "placeholder",
+        "options",
+        "min",
+        "max",
+        "max_length",
+    ],
+    "properties": {
+        "key": {"type": "string"},
+        "label": {"type": "string"},
+        "type": {"type": "string", "enum": ["short_text", "number", "select", "multiselect", "boolean", "date"]},
+        "required": {"type": "boolean"},
+        "help": {"type": ["string", "null"]},
+        "placeholder": {"type": ["string", "null"]},
+        "options": {"type": ["array", "null"], "items": {"type": "string"}},
+        "min": {"type": ["number", "null"]},
+        "max": {"type": ["number", "null"]},
+        "max_length": {"type": ["integer", "null"]},
+    },
+}
+
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "assistant_reply",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "additionalProperties": False,
+            "required": ["assistant_message", "next_choices", "requested_form", "final"],
+            "properties": {
+                "assistant_message": {"type": "string"},
+                "next_choices": {"type": "array", "items": {"type": "string"}},
+                "requested_form": {
+                    "anyOf": [
+                        {"type": "null"},
+                        {
+                            "type": "object",
+                            "additionalProperties": False,
+                            "required": ["title", "submit_label", "fields"],
+                            "properties": {
+                                "title": {"type": "string"},
+                                "submit_label": {"type": "string"},
+                                "fields": {"type": "array", "items": FORM_FIELD_SCHEMA},
+                            },
+                        },
+                    ]
+                },
+                "final": {"type": "boolean"},
+            },
+        },
+    },
+}
+
+SUMMARY_PROMPT = """
+Summarize the support conversation below in a few sentences.
+Keep identifiers, decisions and open questions. Do not add new information.
+""".strip()
+
+
+if orjson is not None:
+    _loads = orjson.loads
+
+    def _dumps(obj: Any, indent: bool = False) -> str:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option).decode()
+
+    def _dumps_bytes(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+else:
+    _loads = json.loads
+
+    def _dumps(obj: Any, indent: bool = False) -> str:
+        if indent:
+            return json.dumps(obj, ensure_ascii=False, indent=2)
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+    def _dumps_bytes(obj: Any) -> bytes:
+        return _dumps(obj).encode()
+
 
 def _extract_json_object(content: str) -> dict[str, Any] | None:
     content = content.strip()
-    try:
-        parsed = json.loads(content)
-        if isinstance(parsed, dict):
-            return parsed
-    except json.JSONDecodeError:
-        pass
-
-    match = re.search(r"\{.*\}", content, re.DOTALL)
-    if not match:
+    if content.startswith("{"):
+        try:
+            parsed = _loads(content)
+            if isinstance(parsed, dict):
+                return parsed
+        except json.JSONDecodeError:
+            pass
+
+    start = content.find("{")
+    if start < 0:
         return None
 
     try:
-        parsed = json.loads(match.group(0))
+        # raw_decode stops at the end of the first complete value, so trailing prose is ignored.
+        parsed, _ = JSON_DECODER.raw_decode(content, start)
         if isinstance(parsed, dict):
             return parsed
     except json.JSONDecodeError:
@@ -71,6 +186,7 @@ def _extract_json_object(content: str) -> dict[str, Any] | None:
     return None
 
 
+@st.cache_data(max_entries=128)
 def _normalize_model_output(raw_content: str) -> dict[str, Any]:
     parsed = _extract_json_object(raw_content)
     if not parsed:
@@ -81,17 +197,213 @@ def _normalize_model_output(raw_content: str) -> dict[str, Any]:
             "final": False,
         }
 
+    next_choices = []
+    for choice in parsed.get("next_choices") or ():
+        text = choice if type(choice) is str else str(choice)
+        if text and not text.isspace():
+            next_choices.append(text)
+
     return {
         "assistant_message": str(parsed.get("assistant_message", "")),
-        "next_choices": [str(x) for x in parsed.get("next_choices", []) if str(x).strip()],
+        "next_choices": next_choices,
         "requested_form": parsed.get("requested_form"),
         "final": bool(parsed.get("final", False)),
     }
 
 
-def _api_messages(chat_history: list[dict[str, str]], language: str) -> list[dict[str, str]]:
+@st.cache_resource
+def _http_session() -> requests.Session:
+    session = requests.Session()
+    retry = Retry(
+        total=2,
+        # A read timeout may mean the generation is already running; re-sending it would bill it again.
+        read=0,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST"],
+        # Hand the last 429/5xx back so raise_for_status() reports it instead of an opaque RetryError.
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@st.cache_resource
+def _response_cache() -> OrderedDict[str, tuple[float, list[dict[str, Any]]]]:
+    return OrderedDict()
+
+
+def _response_cache_key(api_url: str, api_token: str, model: str, language: str, history_hash: bytes) -> str:
+    token_fingerprint = hashlib.sha1(api_token.encode()).hexdigest()[:8]
+    parts = [history_hash, api_url.encode(), token_fingerprint.encode(), model.encode(), language.encode()]
+    return hashlib.sha256(b"\0".join(parts)).hexdigest()
+
+
+def _cached_candidates(
+    api_url: str, api_token: str, model: str, language: str, history_hash: bytes
+) -> list[dict[str, Any]] | None:
+    # The cache is shared by all sessions: keys are scoped to the API token, and conversations carrying
+    # submitted form data (possibly personal data) never read from or write to it.
+    if st.session_state.form_submissions:
+        return None
+    cached = _response_cache().get(_response_cache_key(api_url, api_token, model, language, history_hash))
+    if cached and time.monotonic() - cached[0] < RESPONSE_CACHE_TTL_S:
+        return cached[1]
+    return None
+
+
+@st.cache_resource(max_entries=16)
+def _system_message(language: str, cache_control: bool = False) -> dict[str, Any]:
+    # Shared across reruns so the prompt prefix stays identical between turns (provider prompt caching).
     system_prompt = SYSTEM_PROMPT_TEMPLATE.replace("__LANGUAGE__", language)
-    return [{"role": "system", "content": system_prompt}, *chat_history]
+    if cache_control:
+        return {
+            "role": "system",
+            "content": [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}],
+        }
+    return {"role": "system", "content": system_prompt}
+
+
+def _api_messages(
+    chat_history: list[dict[str, str]],
+    language: str,
+    summary: dict[str, Any] | None = None,
+    cache_control: bool = False,
+) -> list[dict[str, Any]]:
+    system_message = _system_message(language, cache_control)
+    if summary:
+        return [system_message, summary["message"], *chat_history[summary["count"] :]]
+    return [system_message, *chat_history]
+
+
+def _chain_digest(previous: bytes, message: dict[str, str]) -> bytes:
+    return hashlib.sha256(previous + _dumps_bytes((message["role"], message["content"]))).digest()
+
+
+def _request_headers(api_token: str) -> dict[str, str]:
+    headers = {"Content-Type": "application/json"}
+    if api_token:
+        headers["Authorization"] = f"Bearer {api_token}"
+    return headers
+
+
+def _content_text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join([part["text"] for part in content if "text" in part])
+    return "" if content is None else str(content)
+
+
+def _stream_content(response: requests.Response) -> Iterator[tuple[int, str]]:
+    # A refused choice carries its explanation in "refusal" instead of "content"; surface it when nothing else came.
+    refusals: dict[int, list[str]] = {}
+    answered = False
+    if not response.headers.get("Content-Type", "").startswith("text/event-stream"):
+        data = _loads(response.content)
+        for index, choice in enumerate(data["choices"]):
+            message = choice["message"]
+            if message.get("refusal"):
+                refusals.setdefault(choice.get("index", index), []).append(message["refusal"])
+            else:
+                answered = True
+                yield choice.get("index", index), _content_text(message["content"])
+    else:
+        for line in response.iter_lines():
+            if not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+
+            chunk = _loads(data)
+            if "error" in chunk:
+                raise RuntimeError(str(chunk["error"]))
+            for index, choice in enumerate(chunk.get("choices") or []):
+                delta = choice.get("delta") or {}
+                if delta.get("refusal"):
+                    refusals.setdefault(choice.get("index", index), []).append(delta["refusal"])
+                text = _content_text(delta.get("content"))
+                if text:
+                    answered = True
+                    yield choice.get("index", index), text
+
+    if refusals and not answered:
+        raise RuntimeError(f"The model refused to answer: {''.join(refusals[min(refusals)])}")
+
+
+def _collect_choices(deltas: Iterable[tuple[int, str]], chunks: dict[int, list[str]]) -> Iterator[str]:
+    for index, text in deltas:
+        chunks.setdefault(index, []).append(text)
+        if index == 0:
+            yield text
+
+
+def _string_value_end(buffer: str, start: int) -> tuple[int, bool]:
+    i = start
+    while i < len(buffer):
+        char = buffer[i]
+        if char == '"':
+            return i, True
+        if char == "\\":
+            width = 2
+            if buffer.startswith("u", i + 1):
+                # A high surrogate is only decodable together with its low surrogate.
+                width = 12 if buffer[i + 2 : i + 4].lower() in ("d8", "d9", "da", "db") else 6
+            if i + width > len(buffer):
+                break
+            i += width
+        else:
+            i += 1
+    return i, False
+
+
+def _assistant_message_preview(deltas: Iterable[str]) -> Iterator[str]:
+    buffer = ""
+    position = -1
+    closed = False
+    for delta in deltas:
+        if closed:
+            continue
+        buffer += delta
+
+        if position < 0:
+            key_index = buffer.find(ASSISTANT_MESSAGE_KEY)
+            if key_index < 0:
+                continue
+            rest = buffer[key_index + len(ASSISTANT_MESSAGE_KEY) :].lstrip()
+            if not rest.startswith(":") or not rest[1:].lstrip().startswith('"'):
+                continue
+            position = len(buffer) - len(rest[1:].lstrip()) + 1
+
+        end, closed = _string_value_end(buffer, position)
+        if end > position:
+            fragment = buffer[position:end]
+            try:
+                yield _loads(f'"{fragment}"')
+            except json.JSONDecodeError:
+                yield fragment
+            position = end
+
+
+def _summarize_history(api_url: str, api_token: str, model: str, chat_history: list[dict[str, str]]) -> str:
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in chat_history)
+    payload = {
+        "model": model,
+        "messages": [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": transcript}],
+        "temperature": 0,
+    }
+    response = _http_session().post(
+        api_url,
+        headers=_request_headers(api_token),
+        data=_dumps_bytes(payload),
+        timeout=DEFAULT_TIMEOUT_S,
+    )
+    response.raise_for_status()
+    data = _loads(response.content)
+    return _content_text(data["choices"][0]["message"]["content"]).strip()
 
 
 def _call_chat_completion(
@@ -100,52 +412,238 @@ def _call_chat_completion(
     model: str,
     language: str,
     chat_history: list[dict[str, str]],
-) -> dict[str, Any]:
+    history_hash: bytes,
+    summary: dict[str, Any] | None = None,
+) -> list[dict[str, Any]]:
     payload = {
         "model": model,
-        "messages": _api_messages(chat_history, language),
+        # Anthropic models only cache prompt prefixes that carry an explicit cache_control breakpoint.
+        "messages": _api_messages(chat_history, language, summary, cache_control=model.startswith("claude")),
         "temperature": 0.2,
+        "stream": True,
     }
-    headers = {"Content-Type": "application/json"}
-    if api_token.strip():
-        headers["Authorization"] = f"Bearer {api_token.strip()}"
+    # Other OpenAI-compatible servers may reject fields they do not implement, so these stay OpenAI-only.
+    if urlparse(api_url).hostname == "api.openai.com":
+        if model.startswith(STRUCTURED_OUTPUT_MODELS) and not model.startswith(UNSTRUCTURED_OUTPUT_MODELS):
+            payload["response_format"] = RESPONSE_FORMAT
+        payload["n"] = CANDIDATE_RESPONSES
+        payload["prompt_cache_key"] = f"skrepa-chat-{language}"
 
-    response = requests.post(api_url, headers=headers, json=payload, timeout=DEFAULT_TIMEOUT_S)
-    response.raise_for_status()
-    data = response.json()
+    with st.spinner("Thinking…"):
+        response = _http_session().post(
+            api_url,
+            headers=_request_headers(api_token),
+            data=_dumps_bytes(payload),
+            timeout=DEFAULT_TIMEOUT_S,
+            stream=True,
+        )
+        response.raise_for_status()
 
-    content = data["choices"][0]["message"]["content"]
-    if isinstance(content, list):
-        content = "\n".join(part.get("text", "") for part in content if isinstance(part, dict))
+    chunks: dict[int, list[str]] = {}
+    with response, st.chat_message("assistant"):
+        st.write_stream(_assistant_message_preview(_collect_choices(_stream_content(response), chunks)))
 
-    return _normalize_model_output(str(content))
+    candidates = [_normalize_model_output("".join(chunks[index])) for index in sorted(chunks)]
+    candidates = candidates or [_normalize_model_output("")]
+    # Form data never enters the shared cache; see _cached_candidates.
+    if not st.session_state.form_submissions and not candidates[0]["final"]:
+        cache = _response_cache()
+        cache[_response_cache_key(api_url, api_token, model, language, history_hash)] = (time.monotonic(), candidates)
+        while len(cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+    return candidates
 
 
 def _reset_conversation():
-    for key in ["chat_history", "pending_choices", "pending_form", "conversation_done", "accepted_terms"]:
+    for key in [
+        "chat_history",
+        "history_hash",
+        "history_parent_hash",
+        "history_checkpoint",
+        "history_summary",
+        "form_submissions",
+        "spare_responses",
+        "pending_choices",
+        "pending_form",
+        "conversation_done",
+        "accepted_terms",
+    ]:
         st.session_state.pop(key, None)
 
 
 def _init_state():
     if "chat_history" not in st.session_state:
         st.session_state.chat_history = []
+    if "history_hash" not in st.session_state:
+        st.session_state.history_hash = b""
+    if "history_parent_hash" not in st.session_state:
+        st.session_state.history_parent_hash = b""
+    if "form_submissions" not in st.session_state:
+        st.session_state.form_submissions = {}
     if "pending_choices" not in st.session_state:
         st.session_state.pending_choices = []
     if "pending_form" not in st.session_state:
         st.session_state.pending_form = None
+    if "spare_responses" not in st.session_state:
+        st.session_state.spare_responses = None
     if "conversation_done" not in st.session_state:
         st.session_state.conversation_done = False
     if "accepted_terms" not in st.session_state:
         st.session_state.accepted_terms = False
 
 
+@st.cache_data(max_entries=8)
+def _parse_starters(raw: str) -> tuple[str, ...]:
+    return tuple(starter for starter in (line.strip() for line in raw.splitlines()) if starter)
+
+
+def _form_submission_fragments(payload: dict[str, Any]) -> tuple[str, str]:
+    friendly_lines = [f"**{str(key).replace('_', ' ').title()}:** {value}" for key, value in payload.items()]
+    return "\n".join(friendly_lines), _dumps(payload, indent=True)
+
+
+def _render_message(role: str, content: str) -> tuple[str, str | None]:
+    if role != "user" or not content.startswith("FORM_SUBMISSION: "):
+        return content, None
+
+    rendered = st.session_state.form_submissions.get(content)
+    if rendered is None:
+        payload_text = content.replace("FORM_SUBMISSION: ", "", 1)
+        try:
+            rendered = _form_submission_fragments(_loads(payload_text))
+        except json.JSONDecodeError:
+            rendered = ("Form submitted.", payload_text)
+        st.session_state.form_submissions[content] = rendered
+    return rendered
+
+
+def _history_markdown(messages: list[dict[str, str]]) -> str:
+    blocks: list[str] = []
+    previous_role = None
+    for message in messages:
+        markdown_text, _ = _render_message(message["role"], message["content"])
+        if message["role"] == previous_role:
+            blocks[-1] += f"\n\n{markdown_text}"
+        else:
+            blocks.append(f"**{ROLE_LABELS.get(message['role'], message['role'])}:**\n\n{markdown_text}")
+        previous_role = message["role"]
+    return "\n\n---\n\n".join(blocks)
+
+
+def _append_message(role: str, content: str):
+    chat_history = st.session_state.chat_history
+    message = {"role": role, "content": content}
+    chat_history.append(message)
+    # Chained so the digest of an append-only history is updated in O(len(message)).
+    st.session_state.history_parent_hash = st.session_state.history_hash
+    st.session_state.history_hash = _chain_digest(st.session_state.history_hash, message)
+    st.session_state.history_checkpoint = (id(chat_history), len(chat_history))
+
+
+def _replace_last_message(parent_hash: bytes, role: str, content: str):
+    message = {"role": role, "content": content}
+    st.session_state.chat_history[-1] = message
+    st.session_state.history_parent_hash = parent_hash
+    st.session_state.history_hash = _chain_digest(parent_hash, message)
+
+
+def _submit_user_message(content: str):
+    # A user turn left unanswered (the run was interrupted mid-request, or the request failed) is replaced
+    # rather than followed by a second user message.
+    if st.session_state.chat_history[-1]["role"] == "user":
+        _replace_last_message(st.session_state.history_parent_hash, "user", content)
+    else:
+        _append_message("user", content)
+
+
 def _ensure_greeting(greeting: str):
     if not st.session_state.chat_history:
-        st.session_state.chat_history = [{"role": "assistant", "content": greeting}]
+        _append_message("assistant", greeting)
+
+
+@dataclass(slots=True, frozen=True)
+class FieldSpec:
+    key: str
+    label: str
+    type: str
+    help: str
+    required: bool
+    placeholder: str
+    min_value: Any
+    max_value: Any
+    value: Any
+    options: tuple[str, ...]
+
+
+@st.cache_resource(max_entries=32)
+def _compile_form(spec_json: str) -> tuple[FieldSpec, ...]:
+    requested_form = _loads(spec_json)
+    fields = requested_form.get("fields", []) if isinstance(requested_form, dict) else []
+
+    specs = []
+    for field in fields:
+        key = str(field.get("key", "")).strip()
+        if not key:
+            continue
+        specs.append(
+            FieldSpec(
+                key=key,
+                label=str(field.get("label") or key),
+                type=str(field.get("type") or "short_text").lower(),
+                help=str(field.get("help") or ""),
+                required=bool(field.get("required", False)),
+                placeholder=str(field.get("placeholder") or ""),
+                min_value=field.get("min"),
+                max_value=field.get("max"),
+                value=field["min"] if field.get("min") is not None else 0,
+                options=tuple(str(x) for x in field.get("options") or ()),
+            )
+        )
+    return tuple(specs)
+
+
+def _short_text_widget(field: FieldSpec) -> str:
+    return st.text_input(field.label, help=field.help, placeholder=field.placeholder, max_chars=40)
+
+
+def _number_widget(field: FieldSpec) -> int | float | None:
+    return st.number_input(
+        field.label,
+        help=field.help,
+        min_value=field.min_value,
+        max_value=field.max_value,
+        value=field.value,
+    )
+
+
+def _select_widget(field: FieldSpec) -> str | None:
+    return st.selectbox(field.label, options=field.options, help=field.help, index=None)
+
+
+def _multiselect_widget(field: FieldSpec) -> list[str]:
+    return st.multiselect(field.label, options=field.options, help=field.help)
+
+
+def _boolean_widget(field: FieldSpec) -> bool:
+    return st.toggle(field.label, help=field.help)
+
+
+def _date_widget(field: FieldSpec) -> str:
+    return str(st.date_input(field.label, help=field.help))
+
+
+FIELD_WIDGETS = {
+    "short_text": _short_text_widget,
+    "number": _number_widget,
+    "select": _select_widget,
+    "multiselect": _multiselect_widget,
+    "boolean": _boolean_widget,
+    "date": _date_widget,
+}
 
 
 def _render_form(requested_form: dict[str, Any]) -> dict[str, Any] | None:
-    fields = requested_form.get("fields", []) if isinstance(requested_form, dict) else []
+    fields = _compile_form(_dumps(requested_form))
     if not fields:
         return None
 
@@ -154,80 +652,107 @@ def _render_form(requested_form: dict[str, Any]) -> dict[str, Any] | None:
         values: dict[str, Any] = {}
 
         for field in fields:
-            key = str(field.get("key", "")).strip()
-            if not key:
+            widget = FIELD_WIDGETS.get(field.type)
+            if widget is None:
+                st.warning(f"Unsupported field type '{field.type}' was skipped.")
                 continue
+            values[field.key] = widget(field)
 
-            label = str(field.get("label", key))
-            field_type = str(field.get("type", "short_text")).lower()
-            help_text = str(field.get("help", ""))
-            required = bool(field.get("required", False))
-
-            if field_type == "short_text":
-                values[key] = st.text_input(
-                    label,
-                    help=help_text,
-                    placeholder=str(field.get("placeholder", "")),
-                    max_chars=40,
-                )
-            elif field_type == "number":
-                values[key] = st.number_input(
-                    label,
-                    help=help_text,
-                    min_value=field.get("min"),
-                    max_value=field.get("max"),
-                    value=field.get("min", 0),
-                )
-            elif field_type == "select":
-                options = [str(x) for x in field.get("options", [])]
-                values[key] = st.selectbox(label, options=options, help=help_text, index=None)
-            elif field_type == "multiselect":
-                options = [str(x) for x in field.get("options", [])]
-                values[key] = st.multiselect(label, options=options, help=help_text)
-            elif field_type == "boolean":
-                values[key] = st.toggle(label, help=help_text)
-            elif field_type == "date":
-                values[key] = str(st.date_input(label, help=help_text))
-            else:
-                st.warning(f"Unsupported field type '{field_type}' was skipped.")
-                continue
-
-            if required and values.get(key) in (None, "", []):
-                st.caption(f"`{label}` is required.")
+            if field.required and values.get(field.key) in (None, "", []):
+                st.caption(f"`{field.label}` is required.")
 
         submitted = st.form_submit_button(requested_form.get("submit_label", "Submit details"), type="primary")
 
     if not submitted:
         return None
 
-    missing_required = []
-    for field in fields:
-        if field.get("required") and values.get(field.get("key")) in (None, "", []):
-            missing_required.append(field.get("label", field.get("key")))
+    missing_required = [
+        field.label for field in fields if field.required and values.get(field.key) in (None, "", [])
+    ]
     if missing_required:
-        st.error(f"Please complete required fields: {', '.join(map(str, missing_required))}")
+        st.error(f"Please complete required fields: {', '.join(missing_required)}")
         return None
 
     return values
 
 
+def _rolled_summary(
+    api_url: str, token: str, model: str, chat_history: list[dict[str, str]]
+) -> dict[str, Any] | None:
+    summary = st.session_state.get("history_summary")
+    summarized_count = summary["count"] if summary else 0
+    count = len(chat_history) - SUMMARY_KEEP_MESSAGES
+    to_summarize = chat_history[summarized_count:count]
+    # Only the span that would actually be folded in counts towards the budget; the kept tail does not, so a
+    # roll empties the span and [system, summary] stays identical until it has grown past the budget again.
+    if sum(len(message["content"]) for message in to_summarize) <= SUMMARY_TRIGGER_CHARS:
+        return summary
+
+    if summary:
+        to_summarize = [summary["message"], *to_summarize]
+    with st.spinner("Summarizing earlier conversation…"):
+        summary_text = _summarize_history(api_url, token, model, to_summarize)
+    summary = {
+        "count": count,
+        "message": {"role": "system", "content": f"Summary of the earlier conversation: {summary_text}"},
+    }
+    st.session_state.history_summary = summary
+    return summary
+
+
 def _trigger_assistant_turn(api_url: str, token: str, model: str):
-    with st.spinner("Thinking…"):
-        result = _call_chat_completion(
-            api_url,
-            token,
-            model,
-            st.session_state.response_language,
-            st.session_state.chat_history,
-        )
+    token = token.strip()
+    chat_history = st.session_state.chat_history
+    history_hash = st.session_state.history_hash
+    assert st.session_state.history_checkpoint == (id(chat_history), len(chat_history)) and (
+        _chain_digest(st.session_state.history_parent_hash, chat_history[-1]) == history_hash
+    ), "chat_history must only grow through _append_message to keep the prompt prefix cacheable"
 
+    language = st.session_state.response_language
+    # The cache key does not depend on the summary, so a hit must not pay for rolling it.
+    candidates = _cached_candidates(api_url, token, model, language, history_hash)
+    if candidates is None:
+        summary = _rolled_summary(api_url, token, model, chat_history)
+        candidates = _call_chat_completion(api_url, token, model, language, chat_history, history_hash, summary)
+
+    st.session_state.spare_responses = {"key": history_hash, "results": candidates[1:]}
+    _apply_assistant_result(candidates[0])
+
+
+def _apply_assistant_result(result: dict[str, Any], parent_hash: bytes | None = None):
     assistant_text = result["assistant_message"].strip() or "I can help you continue with structured choices."
-    st.session_state.chat_history.append({"role": "assistant", "content": assistant_text})
+    if parent_hash is None:
+        _append_message("assistant", assistant_text)
+    else:
+        _replace_last_message(parent_hash, "assistant", assistant_text)
     st.session_state.pending_choices = result["next_choices"]
     st.session_state.pending_form = result["requested_form"]
     st.session_state.conversation_done = result["final"]
 
 
+def _use_alternative_response():
+    spares = st.session_state.spare_responses
+    if _chain_digest(spares["key"], st.session_state.chat_history[-1]) != st.session_state.history_hash:
+        st.session_state.spare_responses = None
+        return
+    _apply_assistant_result(spares["results"].pop(0), parent_hash=spares["key"])
+
+
+def _render_transcript():
+    earlier_messages = st.session_state.chat_history[:-RECENT_MESSAGES]
+    if earlier_messages:
+        with st.expander("Earlier messages"):
+            st.markdown(_history_markdown(earlier_messages))
+
+    for message in st.session_state.chat_history[-RECENT_MESSAGES:]:
+        with st.chat_message(message["role"]):
+            markdown_text, submitted_json = _render_message(message["role"], message["content"])
+            st.markdown(markdown_text)
+            if submitted_json is not None:
+                with st.expander("Form submitted"):
+                    st.code(submitted_json, language="json")
+
+
 with st.sidebar:
     st.title("Skrepa Chat")
 
@@ -297,64 +822,57 @@ if not st.session_state.accepted_terms:
     st.stop()
 
 _ensure_greeting(greeting_text)
-starters = [line.strip() for line in starters_raw.splitlines() if line.strip()]
+starters = _parse_starters(starters_raw)
 
-for message in st.session_state.chat_history:
-    with st.chat_message(message["role"]):
-        content = message["content"]
-        if message["role"] == "user" and content.startswith("FORM_SUBMISSION: "):
-            payload_text = content.replace("FORM_SUBMISSION: ", "", 1)
-            try:
-                payload = json.loads(payload_text)
-            except json.JSONDecodeError:
-                st.markdown("Form submitted.")
-                with st.expander("Form submitted"):
-                    st.code(payload_text, language="json")
-            else:
-                friendly_lines = [f"**{str(key).replace('_', ' ').title()}:** {value}" for key, value in payload.items()]
-                st.markdown("\n".join(friendly_lines))
-                with st.expander("Form submitted"):
-                    st.code(json.dumps(payload, ensure_ascii=False, indent=2), language="json")
-        else:
-            st.markdown(content)
+_render_transcript()
+
+spare_responses = st.session_state.spare_responses
+if spare_responses and spare_responses["results"] and st.session_state.chat_history[-1]["role"] == "assistant":
+    if st.button("Try alternative"):
+        _use_alternative_response()
+        st.rerun()
+
+if st.session_state.conversation_done:
+    with st.container():
+        st.success("Conversation completed.")
+        feedback = st.feedback("thumbs", key="conversation_feedback")
+        if feedback is not None:
+            st.caption("Thanks for your feedback.")
+        if st.button("Start new conversation"):
+            _reset_conversation()
+            st.rerun()
+    st.stop()
 
-if len(st.session_state.chat_history) == 1 and starters:
+chat_history = st.session_state.chat_history
+awaiting_first_reply = len(chat_history) == 1 or (len(chat_history) == 2 and chat_history[-1]["role"] == "user")
+if awaiting_first_reply and starters:
     selected_starter = st.pills("Choose a starter question", starters, selection_mode="single")
     if selected_starter:
-        st.session_state.chat_history.append({"role": "user", "content": selected_starter})
+        _submit_user_message(selected_starter)
         try:
             _trigger_assistant_turn(api_url, api_token, model)
             st.rerun()
         except Exception as exc:
             st.error(f"Chat completion request failed: {exc}")
 
-if st.session_state.pending_choices and not st.session_state.conversation_done:
+if st.session_state.pending_choices:
     selected_choice = st.pills("Choose your next step", st.session_state.pending_choices, selection_mode="single")
     if selected_choice:
-        st.session_state.chat_history.append({"role": "user", "content": selected_choice})
+        _submit_user_message(selected_choice)
         try:
             _trigger_assistant_turn(api_url, api_token, model)
             st.rerun()
         except Exception as exc:
             st.error(f"Chat completion request failed: {exc}")
 
-if st.session_state.pending_form and not st.session_state.conversation_done:
+if st.session_state.pending_form:
     form_values = _render_form(st.session_state.pending_form)
     if form_values is not None:
-        user_payload = json.dumps(form_values, ensure_ascii=False)
-        st.session_state.chat_history.append({"role": "user", "content": f"FORM_SUBMISSION: {user_payload}"})
+        user_content = f"FORM_SUBMISSION: {_dumps(form_values)}"
+        st.session_state.form_submissions[user_content] = _form_submission_fragments(form_values)
+        _submit_user_message(user_content)
         try:
             _trigger_assistant_turn(api_url, api_token, model)
             st.rerun()
         except Exception as exc:
             st.error(f"Chat completion request failed: {exc}")
-
-if st.session_state.conversation_done:
-    with st.container():
-        st.success("Conversation completed.")
-        feedback = st.feedback("thumbs", key="conversation_feedback")
-        if feedback is not None:
-            st.caption("Thanks for your feedback.")
-        if st.button("Start new conversation"):
-            _reset_conversation()
-            st.rerun()